@@ -1,3 +1,6 @@
+    -- 8 KiB pages; only effective on a fresh database (or after VACUUM)
+    PRAGMA page_size=8192;
+
     CREATE TABLE IF NOT EXISTS messages (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         source TEXT,
@@ -12,4 +15,15 @@
         quoteId INTEGER,
         quoteAuthor TEXT,
         quoteText TEXT
-    )
\ No newline at end of file
+    );
+
+    CREATE TABLE IF NOT EXISTS message_attachments (
+        message_id INTEGER,
+        path TEXT,
+        FOREIGN KEY(message_id) REFERENCES messages(id)
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_att_msg ON message_attachments(message_id);
+
+    -- Per-message attachment paths can be read back with:
+    --   SELECT message_id, group_concat(path) FROM message_attachments GROUP BY message_id
\ No newline at end of file